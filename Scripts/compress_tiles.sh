@@ -43,4 +43,13 @@ find "$SOURCE_DIR" -type f -name "*.jpg" | while read -r file; do
             "$file"
 done
 
+# The web viewer needs map.json from create_zoom_levels.py alongside the tiles. Its generation
+# versions the browser tile caches, so replace it with a hash of the compressed tiles, which
+# changes whenever the source tiles or the compression settings do
+if [ -f "$SOURCE_DIR/map.json" ]; then
+    generation=$(cd "$DEST_DIR" && find . -type f -name "*.jpg" -print0 | sort -z | xargs -0 sha1sum | sha1sum | cut -c1-16)
+    sed "s/\"generation\": \"[^\"]*\"/\"generation\": \"$generation\"/" "$SOURCE_DIR/map.json" > "$DEST_DIR/map.json"
+    echo "Wrote map.json with generation $generation"
+fi
+
 echo "Image conversion complete!"
@@ -2,6 +2,9 @@ import argparse
 from enum import Enum
 import os
 import glob
+import json
+import base64
+import hashlib
 from PIL import Image, ImageOps
 
 class MapTile():
@@ -60,15 +63,17 @@ class MapTile():
         os.makedirs(self.coordinate_directory, exist_ok=True)
 
 class MapTileContainer():
-    max_lod: int = 5
+    metadata_filename: str = "map.json"
+    metadata_version: int = 1
+    leaflet_tile_size: int = 256 # Leaflet's default tileSize, which the CRS transformation is derived from
 
     basedir: str
     map_tiles: dict[int, list[MapTile]]
-    zoom_level: int # 5 is the most zoomed in, 0 is the least zoomed in
+    max_lod: int # 0 is the most zoomed in, max_lod is a single tile covering the whole map
     _tile_size: int
 
     @classmethod
-    def from_directory(cls, directory: str, background_color: str) -> "MapTileContainer":
+    def from_directory(cls, directory: str, background_color: str, max_lod: int|None = None) -> "MapTileContainer":
         glob_path = os.path.join(directory, MapTile.get_glob())
         matching_files = glob.glob(glob_path)
         lod_tiles: dict[int, list[MapTile]] = {}
@@ -85,19 +90,22 @@ class MapTileContainer():
             lod_tiles[lod_level].append(tile)
         if len(lod_tiles) == 0:
             raise Exception("No LOD tiles found")
-        return cls(lod_tiles, directory, background_color)
+        if 0 not in lod_tiles:
+            raise Exception("No LOD 0 tiles found")
+        return cls(lod_tiles, directory, background_color, max_lod)
     
-    def __init__(self, tile_dict: dict[int, list[MapTile]], basedir: str, background_color: str):
+    def __init__(self, tile_dict: dict[int, list[MapTile]], basedir: str, background_color: str, max_lod: int|None = None):
         self.map_tiles = tile_dict
         self.basedir = basedir
         self._tile_size = self.find_tile_size()
         self._background_hex = background_color
+        self.max_lod = max_lod if max_lod is not None else self.find_max_lod()
         print(self)
 
     def __str__(self):
         # Construct a summary of { zoom level: number of tiles }
         summary = {zoom_level: len(tiles) for zoom_level, tiles in self.map_tiles.items()}
-        return f"MapTileContainer: {summary}"
+        return f"MapTileContainer: {summary}, max LOD {self.max_lod}"
 
     @property
     def background_color(self):
@@ -112,6 +120,22 @@ class MapTileContainer():
         size = tile.image.size
         return size[0]
 
+    def find_max_lod(self):
+        # The shallowest LOD where the whole LOD 0 extent collapses into a single tile.
+        # Going any higher would only produce tiles that are mostly background.
+        min_x, min_z = self.min_worldspace_coordinates(0)
+        max_x, max_z = self.max_worldspace_coordinates(0)
+
+        # Tiles are aligned to 0, so an extent crossing 0 never fits one tile. It ends up
+        # spanning tiles -1 and 0 instead, which is as far as it can collapse
+        def collapsed(min_coord: int, max_coord: int, lod: int) -> bool:
+            return (max_coord >> lod) - (min_coord >> lod) == 0 or (min_coord >> lod, max_coord >> lod) == (-1, 0)
+
+        lod = 0
+        while not (collapsed(min_x, max_x, lod) and collapsed(min_z, max_z, lod)):
+            lod += 1
+        return lod
+
     def min_worldspace_coordinates(self, lod: int):
         min_x = min([tile.xCoord for tile in self.map_tiles[lod]])
         min_z = min([tile.zCoord for tile in self.map_tiles[lod]])
@@ -140,11 +164,11 @@ class MapTileContainer():
         min_x, min_z = self.min_worldspace_coordinates(lod-1)
         max_x, max_z = self.max_worldspace_coordinates(lod-1) 
 
-        # round to the nearest even number
+        # round down to the nearest even number, so each step starts a 2x2 grid
         min_x = min_x - (min_x % 2)
         min_z = min_z - (min_z % 2)
-        max_x = max_x + (max_x % 2)
-        max_z = max_z + (max_z % 2)
+        max_x = max_x - (max_x % 2)
+        max_z = max_z - (max_z % 2)
 
         print(f"Source tiles from LOD {lod}: min_x={min_x}, max_x={max_x}, min_z={min_z}, max_z={max_z}")
 
@@ -195,18 +219,99 @@ class MapTileContainer():
 
         return map_tile
 
+    def make_occupancy_bitmap(self, lod: int) -> str:
+        # One bit per tile in the LOD's bounding box, row by row from the minimum z, least
+        # significant bit first. Ocean tiles skipped by crop_screenshots.py are left unset,
+        # so the web viewer never requests tiles which don't exist.
+        min_x, min_z = self.min_worldspace_coordinates(lod)
+        max_x, max_z = self.max_worldspace_coordinates(lod)
+        width = max_x - min_x + 1
+        height = max_z - min_z + 1
+        bitmap = bytearray((width * height + 7) // 8)
+        for tile in self.map_tiles[lod]:
+            index = (tile.zCoord - min_z) * width + (tile.xCoord - min_x)
+            bitmap[index // 8] |= 1 << (index % 8)
+        return base64.b64encode(bytes(bitmap)).decode("ascii")
+
+    def make_generation_id(self) -> str:
+        # Changes whenever any tile is rewritten. The web viewer versions its tile caches with
+        # this, so regenerating tiles replaces the copies browsers have cached
+        generation_hash = hashlib.sha1()
+        for lod in range(0, self.max_lod+1):
+            for tile in sorted(self.map_tiles[lod], key=lambda tile: tile.coordinates):
+                tile_stat = os.stat(tile.filepath)
+                generation_hash.update(f"{lod}/{tile.xCoord}/{tile.zCoord}:{tile_stat.st_size}:{tile_stat.st_mtime_ns};".encode("ascii"))
+        return generation_hash.hexdigest()[:16]
+
+    def make_metadata(self, step_size: int) -> dict:
+        # LOD 0 tiles are named by camera position / step_size, and the camera looks down
+        # into the center of each tile, so the tile edges sit half a step either side
+        edge_to_center_offset = step_size / 2
+        min_x, min_z = self.min_worldspace_coordinates(0)
+        max_x, max_z = self.max_worldspace_coordinates(0)
+
+        # Scale so that one LOD 0 tile (step_size world units) spans leaflet_tile_size pixels at max zoom
+        scale = self.leaflet_tile_size / (step_size * 2 ** self.max_lod)
+
+        lods = {}
+        for lod in range(0, self.max_lod+1):
+            lod_min_x, lod_min_z = self.min_worldspace_coordinates(lod)
+            lod_max_x, lod_max_z = self.max_worldspace_coordinates(lod)
+            lods[str(lod)] = {
+                "tile_count": len(self.map_tiles[lod]),
+                "min": [lod_min_x, lod_min_z],
+                "max": [lod_max_x, lod_max_z],
+                "occupancy": self.make_occupancy_bitmap(lod),
+            }
+
+        grid_tile_count = (max_x - min_x + 1) * (max_z - min_z + 1)
+
+        return {
+            "version": self.metadata_version,
+            "generation": self.make_generation_id(),
+            "min_lod": 0,
+            "max_lod": self.max_lod,
+            "tile_size": self._tile_size,
+            "display_tile_size": self.leaflet_tile_size,
+            "step_size": step_size,
+            "edge_to_center_offset": edge_to_center_offset,
+            # World bounds in game coordinates, covering the outer edges of the LOD 0 tiles
+            "bounds": {
+                "min": [min_x * step_size - edge_to_center_offset, min_z * step_size - edge_to_center_offset],
+                "max": [(max_x + 1) * step_size - edge_to_center_offset, (max_z + 1) * step_size - edge_to_center_offset],
+            },
+            # Coefficients for L.Transformation(a, b, c, d), with the y axis inverted
+            "transformation": [scale, 0, -scale, 0],
+            "occupancy": {
+                "lod0_tile_count": len(self.map_tiles[0]),
+                "lod0_grid_tile_count": grid_tile_count,
+                "ratio": round(len(self.map_tiles[0]) / grid_tile_count, 4),
+            },
+            "lods": lods,
+        }
+
+    def write_metadata(self, step_size: int):
+        metadata_filepath = os.path.join(self.basedir, self.metadata_filename)
+        with open(metadata_filepath, "w") as metadata_file:
+            json.dump(self.make_metadata(step_size), metadata_file, indent=2)
+        print(f"Wrote map metadata to {metadata_filepath}")
+
 
 if __name__ == "__main__":
     DEFAULT_OCEAN_COLOR = "#273132"
+    DEFAULT_STEP_SIZE = 100 # Must match the camera step size in the Enfusion Workbench tool
 
     # Set up the args - We take an input directory to locate the screenshots and write tiles next to them
     parser = argparse.ArgumentParser(description="Center crop screenshots to a given resolution")
     parser.add_argument("input_dir", help="The directory containing the screenshots to crop")
     parser.add_argument("-f", "--force-overwrite", action="store_true", help="Force overwrite existing files")
     parser.add_argument("--ocean_color", default=DEFAULT_OCEAN_COLOR, help=f"Hex color code for the ocean (default: {DEFAULT_OCEAN_COLOR}).")
+    parser.add_argument("--step_size", type=int, default=DEFAULT_STEP_SIZE, help=f"Camera step size used when capturing the screenshots (default: {DEFAULT_STEP_SIZE}).")
+    parser.add_argument("--max_lod", type=int, default=None, help="Override the derived maximum LOD level (default: the level where the whole map fits in one tile).")
     args = parser.parse_args()
 
     print(f"Processing screenshots in {args.input_dir}")
-    map_tile_container = MapTileContainer.from_directory(args.input_dir, background_color=args.ocean_color)
+    map_tile_container = MapTileContainer.from_directory(args.input_dir, background_color=args.ocean_color, max_lod=args.max_lod)
     map_tile_container.make_remaining_lod_levels(args.force_overwrite)
+    map_tile_container.write_metadata(args.step_size)
     print("Done creating zoom levels.")
\ No newline at end of file
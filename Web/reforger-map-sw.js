@@ -0,0 +1,144 @@
+// Service worker which caches map tiles, so repeat visits and panning are served without
+// touching the network. Registered by registerTileCache() in reforger-map.js as
+// reforger-map-sw.js?version=G, where G is the generation from the map's map.json.
+// Each map registers with its own scope, and the cache names include that scope so
+// one map's worker never clears out another map's caches.
+
+const CACHE_VERSION = new URL(self.location).searchParams.get('version') || '0';
+const CACHE_PREFIX = `reforger-map|${self.registration.scope}|`; // must match getOfflineTileCacheName()
+const TILE_CACHE_NAME = `${CACHE_PREFIX}tiles-v${CACHE_VERSION}`; // LRU bounded, filled while browsing
+const OFFLINE_CACHE_NAME = `${CACHE_PREFIX}offline-v${CACHE_VERSION}`; // unbounded, filled by downloadMapForOffline()
+const SHELL_CACHE_NAME = `${CACHE_PREFIX}shell-v${CACHE_VERSION}`; // pages, scripts and map.json
+const MAX_TILE_CACHE_ENTRIES = 3000;
+
+const TILE_FILENAME = '/tile.jpg';
+const OFFLINE_DOWNLOAD_HEADER = 'X-Reforger-Offline-Download'; // set by downloadMapForOffline() in reforger-map.js
+
+self.addEventListener('install', event => {
+  self.skipWaiting();
+});
+
+// Drop caches from any previous release, so new tiles replace old ones
+self.addEventListener('activate', event => {
+  event.waitUntil(
+    caches.keys()
+      .then(cacheNames => Promise.all(cacheNames
+        .filter(cacheName => cacheName.startsWith(CACHE_PREFIX) && !cacheName.endsWith(`-v${CACHE_VERSION}`))
+        .map(cacheName => caches.delete(cacheName))))
+      .then(() => self.clients.claim())
+  );
+});
+
+self.addEventListener('fetch', event => {
+  const request = event.request;
+  if (request.method !== 'GET') {
+    return;
+  }
+
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) {
+    return;
+  }
+
+  // The page is storing these in the offline cache itself, so keep them out of ours
+  if (request.headers.has(OFFLINE_DOWNLOAD_HEADER)) {
+    return;
+  }
+
+  if (url.pathname.endsWith(TILE_FILENAME)) {
+    event.respondWith(cacheFirstTile(event));
+  } else {
+    event.respondWith(networkFirstShell(event));
+  }
+});
+
+// Tiles never change within a release, so anything cached is served as-is. Cache writes
+// happen in event.waitUntil() so the response isn't held up by them
+async function cacheFirstTile(event) {
+  const request = event.request;
+  const offlineCache = await caches.open(OFFLINE_CACHE_NAME);
+  const offlineResponse = await offlineCache.match(request);
+  if (offlineResponse) {
+    return offlineResponse;
+  }
+
+  const tileCache = await caches.open(TILE_CACHE_NAME);
+  const cachedResponse = await tileCache.match(request);
+  if (cachedResponse) {
+    event.waitUntil(touchTile(tileCache, request, cachedResponse.clone()));
+    return cachedResponse;
+  }
+
+  const response = await fetch(request);
+  if (response.ok) {
+    event.waitUntil(tileCache.put(request, response.clone()).then(() => trimTileCache(tileCache)));
+  }
+  return response;
+}
+
+// Pages and map.json may change, so prefer the network and only fall back to the cache offline.
+// Pages are stored without their ?center= style parameters, so there's one entry per page,
+// matching how downloadMapForOffline() stores them. Cache writes happen in event.waitUntil()
+async function networkFirstShell(event) {
+  const request = event.request;
+  const cacheKey = getShellCacheKey(request);
+  const shellCache = await caches.open(SHELL_CACHE_NAME);
+  try {
+    const response = await fetch(request);
+    if (response.ok) {
+      event.waitUntil(shellCache.put(cacheKey, response.clone()));
+    }
+    return response;
+  } catch (error) {
+    const cachedResponse = await shellCache.match(cacheKey);
+    if (cachedResponse) {
+      return cachedResponse;
+    }
+
+    const offlineCache = await caches.open(OFFLINE_CACHE_NAME);
+    const offlineResponse = await offlineCache.match(cacheKey);
+    if (offlineResponse) {
+      return offlineResponse;
+    }
+    throw error;
+  }
+}
+
+function getShellCacheKey(request) {
+  if (request.mode !== 'navigate') {
+    return request;
+  }
+  const url = new URL(request.url);
+  url.search = '';
+  url.hash = '';
+  return url.href;
+}
+
+// LRU bookkeeping - cache.keys() is in insertion order, and put() replaces an entry by
+// appending it again, so re-inserting a tile when it is used keeps keys() in least to most
+// recently used order. This lives in the cache itself, so it survives the worker stopping.
+const TRIMMED_TILE_CACHE_ENTRIES = Math.floor(MAX_TILE_CACHE_ENTRIES * 0.9); // trim in batches, not per tile
+
+let tileCountPromise = null; // estimate of the entries in the tile cache, corrected whenever it is trimmed
+
+function touchTile(tileCache, request, cachedResponse) {
+  return tileCache.put(request, cachedResponse);
+}
+
+async function trimTileCache(tileCache) {
+  if (tileCountPromise === null) {
+    // Counted after this tile's put(), so it already includes it
+    tileCountPromise = tileCache.keys().then(requests => requests.length);
+  } else {
+    tileCountPromise = tileCountPromise.then(tileCount => tileCount + 1);
+  }
+  const tileCount = await tileCountPromise;
+  if (tileCount <= MAX_TILE_CACHE_ENTRIES) {
+    return;
+  }
+
+  const requests = await tileCache.keys();
+  const evictedRequests = requests.slice(0, Math.max(0, requests.length - TRIMMED_TILE_CACHE_ENTRIES));
+  tileCountPromise = Promise.resolve(requests.length - evictedRequests.length);
+  await Promise.all(evictedRequests.map(evictedRequest => tileCache.delete(evictedRequest)));
+}
@@ -1,22 +1,76 @@
-const edge_to_center_offset = 50; // from the camera looking down into the center of LOD0 tiles
-const MAX_ZOOM = 5; // If this is changed, it throws off the coordinate conversion - I don't understand why!
+const LEGACY_URL_MAX_ZOOM = 5; // ?zoom= links were shared when Leaflet zoom 0 was always LOD 5
+const TILE_CACHE_PREFIX = 'reforger-map|'; // must match reforger-map-sw.js
+const OFFLINE_DOWNLOAD_HEADER = 'X-Reforger-Offline-Download'; // must match reforger-map-sw.js
+
+// Load the map.json written by create_zoom_levels.py alongside the LOD tiles
+function loadMapMetadata(mapMetadataPath) {
+  // Always revalidate, as its generation decides whether cached tiles are still current
+  return fetch(mapMetadataPath, { cache: 'no-cache' }).then(response => {
+    if (!response.ok) {
+      throw new Error(`Unable to load map metadata from ${mapMetadataPath}: ${response.status}`);
+    }
+    return response.json();
+  });
+}
+
+// Check the occupancy bitmap from map.json for a tile. Tiles skipped as ocean when cropping
+// don't exist, so asking for them would only produce a 404
+var decodedOccupancy = new WeakMap();
+
+function hasTile(mapMetadata, lod, x, z) {
+  var lodRange = mapMetadata.lods[lod];
+  if (!lodRange || x < lodRange.min[0] || x > lodRange.max[0] || z < lodRange.min[1] || z > lodRange.max[1]) {
+    return false;
+  }
+
+  if (!decodedOccupancy.has(lodRange)) {
+    decodedOccupancy.set(lodRange, Uint8Array.from(atob(lodRange.occupancy), c => c.charCodeAt(0)));
+  }
+  var occupancy = decodedOccupancy.get(lodRange);
+  var width = lodRange.max[0] - lodRange.min[0] + 1;
+  var index = (z - lodRange.min[1]) * width + (x - lodRange.min[0]);
+  return (occupancy[index >> 3] & (1 << (index & 7))) !== 0;
+}
 
-function makeMap(mapTilePathTemplate, initialZoom, bounds, mapBufferRatio, extraMapConfiguration) {
-  var zoom = initialZoom;
+// Replace the contents of the map element with an error, for when the map can't be created
+function showMapError(message) {
+  console.log(message);
+  const mapElement = document.getElementById('map');
+  const messageElement = document.createElement('p');
+  messageElement.textContent = message;
+  messageElement.style.color = 'white';
+  messageElement.style.padding = '20px';
+  mapElement.replaceChildren(messageElement);
+}
+
+// Leaflet zooms are reversed LODs, so zoom 0 is max_lod and the highest zoom is min_lod (LOD 0).
+// LODs outside of those generated for this map are clamped to the nearest one.
+function lodToZoom(mapMetadata, lod) {
+  var clampedLod = Math.min(Math.max(lod, mapMetadata.min_lod), mapMetadata.max_lod);
+  return mapMetadata.max_lod - clampedLod;
+}
+
+function makeMap(mapTilePathTemplate, mapMetadata, initialLod, mapBufferRatio, extraMapConfiguration) {
+  var maxZoom = lodToZoom(mapMetadata, mapMetadata.min_lod);
+  var bounds = gameCoordsToBounds(mapMetadata.bounds.min, mapMetadata.bounds.max, mapMetadata.edge_to_center_offset);
+
+  var zoom = lodToZoom(mapMetadata, initialLod);
   var center = bounds.getCenter();
   console.log(center);
 
-  var urlCenterZoom = getCenterZoomFromURL();
-  if (urlCenterZoom) {
-    center = urlCenterZoom.center;
-    zoom = urlCenterZoom.zoom;
+  var urlCenterLod = getCenterLodFromURL();
+  if (urlCenterLod) {
+    center = urlCenterLod.center;
+    zoom = lodToZoom(mapMetadata, urlCenterLod.lod);
   }
 
   // This is specifically for the Reforger/Enfusion maps, which uses a custom CRS
-  // to achieve a 1:1 mapping between game coordinates and lat/lng (or in this case lng/lat)
+  // to achieve a 1:1 mapping between game coordinates and lat/lng (or in this case lng/lat).
+  // The transformation scales one LOD0 tile to display_tile_size pixels at maxZoom.
+  const [a, b, c, d] = mapMetadata.transformation;
   L.CRS.CustomSimple = L.Util.extend({}, L.CRS, {
     projection: L.Projection.LonLat,
-    transformation: new L.Transformation(1/12.501, 0, -1/12.501, 0), // I had to eyeball this scale factor!
+    transformation: new L.Transformation(a, b, c, d),
 
     scale(zoom) {
       return Math.pow(2, zoom);
@@ -40,6 +94,7 @@ function makeMap(mapTilePathTemplate, initialZoom, bounds, mapBufferRatio, extra
       crs: L.CRS.CustomSimple,
       zoom,
       center,
+      edgeToCenterOffset: mapMetadata.edge_to_center_offset,
       ...extraMapConfiguration
   });
   
@@ -48,14 +103,26 @@ function makeMap(mapTilePathTemplate, initialZoom, bounds, mapBufferRatio, extra
     getTileUrl: function(tilecoords) {
       tilecoords.y = -(tilecoords.y + 1);
       return L.TileLayer.prototype.getTileUrl.call(this, tilecoords);
+    },
+
+    // Use an empty tile for anywhere map.json says has no image, rather than requesting it
+    createTile: function(coords, done) {
+      var lod = mapMetadata.max_lod - coords.z;
+      if (!hasTile(mapMetadata, lod, coords.x, -(coords.y + 1))) {
+        const tile = document.createElement('div');
+        setTimeout(() => done(null, tile), 0);
+        return tile;
+      }
+      return L.TileLayer.prototype.createTile.call(this, coords, done);
     }
   });
 
   // create a tile layer, and invert the z axis as we name by LODs
   tileLayer = new L.TileLayer.InvertedY(mapTilePathTemplate, {
-    maxZoom: MAX_ZOOM,
+    maxZoom: maxZoom,
     minZoom: 0,
     zoomReverse: true,
+    tileSize: mapMetadata.display_tile_size,
     bounds: bounds,
   }).addTo(map);
 
@@ -75,7 +142,7 @@ function makeMap(mapTilePathTemplate, initialZoom, bounds, mapBufferRatio, extra
   //   const newUrl = updateUrlParameters(
   //       window.location.href, {
   //         'center': `${center.lat.toFixed(6)}-${center.lng.toFixed(6)}`,
-  //         'zoom': map.getZoom().toFixed(0)
+  //         'lod': (map.getMaxZoom() - map.getZoom()).toFixed(0)
   //       }
   //   );
     
@@ -94,7 +161,7 @@ function addMapMarkers(map, gameCoordinatesList, customIcon = null) {
   }
 
   gameCoordinatesList.forEach(coord => {
-    L.marker(gameCoordsToLatLng([coord[0], coord[1]]), iconParams).addTo(map);
+    L.marker(gameCoordsToLatLng([coord[0], coord[1]], map.options.edgeToCenterOffset), iconParams).addTo(map);
   });
 }
 
@@ -110,7 +177,7 @@ function addClusteredMapMarkers(map, resourceCoordinatesList, customIcon = null)
   });
 
   resourceCoordinatesList.forEach(coord => {
-    var coordLatLng = gameCoordsToLatLng([coord[0], coord[1]]);
+    var coordLatLng = gameCoordsToLatLng([coord[0], coord[1]], map.options.edgeToCenterOffset);
     var coordMarker = L.marker(coordLatLng, markerParams);
     clusteredMarkers.addLayer(coordMarker);
   });
@@ -120,7 +187,7 @@ function addClusteredMapMarkers(map, resourceCoordinatesList, customIcon = null)
 
 // Add custom labels to the map
 function addMapLabel(map, gameCoordinates, label, cssClass) {
-  var latlng = gameCoordsToLatLng(gameCoordinates);
+  var latlng = gameCoordsToLatLng(gameCoordinates, map.options.edgeToCenterOffset);
   L.tooltip(latlng, {
     content: label,
     permanent: true,
@@ -146,23 +213,24 @@ function defineLabelVisibility(map, minZoomLevel, maxZoomLevel, targetSelector,
   });
 }
 
-// coordinate conversion - The +edge_to_center_offset accounts for our offset as the
-// camera looks down into the center of LOD0 tiles, not the corner
+// coordinate conversion - The +edgeToCenterOffset accounts for our offset as the
+// camera looks down into the center of LOD0 tiles, not the corner. It is half the camera
+// step size, taken from map.json and kept in the map's edgeToCenterOffset option
 
-function gameCoordsToLatLng(coordPair) {
-  return L.latLng([coordPair[1] + edge_to_center_offset, coordPair[0] + edge_to_center_offset]);
+function gameCoordsToLatLng(coordPair, edgeToCenterOffset) {
+  return L.latLng([coordPair[1] + edgeToCenterOffset, coordPair[0] + edgeToCenterOffset]);
 }
 
-function latLngToGameCoords(latlng) {
-  return [latlng.lng - edge_to_center_offset, latlng.lat - edge_to_center_offset];
+function latLngToGameCoords(latlng, edgeToCenterOffset) {
+  return [latlng.lng - edgeToCenterOffset, latlng.lat - edgeToCenterOffset];
 }
 
 // Convert game coordinates to a Leaflet bounds object by swapping the x and y for LngLat
-function gameCoordsToBounds(coordPairMin, coordPairMax, padding=0) {
+function gameCoordsToBounds(coordPairMin, coordPairMax, edgeToCenterOffset, padding=0) {
   coordPairMin = [coordPairMin[0] - padding, coordPairMin[1] - padding];
   coordPairMax = [coordPairMax[0] + padding, coordPairMax[1] + padding];
-  const min = gameCoordsToLatLng([coordPairMin[0], coordPairMin[1]]);
-  const max = gameCoordsToLatLng([coordPairMax[0], coordPairMax[1]]);
+  const min = gameCoordsToLatLng([coordPairMin[0], coordPairMin[1]], edgeToCenterOffset);
+  const max = gameCoordsToLatLng([coordPairMax[0], coordPairMax[1]], edgeToCenterOffset);
   return L.latLngBounds(min, max);
 }
 
@@ -193,20 +261,245 @@ function addGridDebug(map) {
   map.addLayer(L.gridLayer.gridDebug());
 }
 
+// Tile caching functions
+
+// Register the service worker which caches tiles, scoped to the page's directory so each map
+// has its own worker and caches. The generation from map.json is passed in the URL, so newly
+// generated tiles install a new worker, which then clears out the old caches
+function registerTileCache(serviceWorkerPath, mapMetadata) {
+  if (!('serviceWorker' in navigator)) {
+    return;
+  }
+
+  navigator.serviceWorker.register(`${serviceWorkerPath}?version=${mapMetadata.generation}`, { scope: './' })
+    .catch(error => console.log(`Tile cache service worker registration failed: ${error}`));
+}
+
+// The service worker names its caches after its scope, which is the page's directory
+function getOfflineTileCacheName(mapMetadata) {
+  var scope = new URL('./', window.location.href).href;
+  return `${TILE_CACHE_PREFIX}${scope}|offline-v${mapMetadata.generation}`;
+}
+
+function runWhenIdle(callback) {
+  if ('requestIdleCallback' in window) {
+    window.requestIdleCallback(callback, { timeout: 2000 });
+  } else {
+    setTimeout(callback, 200);
+  }
+}
+
+// Leaflet tile coordinates covering the given bounds at a zoom level, padded by a number of tiles
+function getTileRange(map, bounds, zoom, tileSize, padding = 0) {
+  var min = map.project(bounds.getNorthWest(), zoom).divideBy(tileSize).floor().subtract([padding, padding]);
+  var max = map.project(bounds.getSouthEast(), zoom).divideBy(tileSize).floor().add([padding, padding]);
+  return L.bounds(min, max);
+}
+
+// Convert a Leaflet tile coordinate into a tile URL, or null if map.json says the tile doesn't exist
+function getTileUrl(mapTilePathTemplate, mapMetadata, lod, x, y) {
+  var z = -(y + 1); // the same y inversion as L.TileLayer.InvertedY
+  if (!hasTile(mapMetadata, lod, x, z)) {
+    return null;
+  }
+  return L.Util.template(mapTilePathTemplate, { z: lod, x: x, y: z });
+}
+
+// Warm the tile cache while the browser is idle, with the ring of tiles just outside the
+// viewport at the current zoom, and the viewport one zoom level in and out
+function addTilePrefetch(map, mapTilePathTemplate, mapMetadata, maxTilesPerMove = 64) {
+  var tileSize = mapMetadata.display_tile_size;
+  var prefetchedUrls = new Set();
+
+  function prefetchAroundViewport() {
+    runWhenIdle(function() {
+      var bounds = map.getBounds();
+      var zoom = map.getZoom();
+      var visibleRange = getTileRange(map, bounds, zoom, tileSize);
+      var urls = [];
+
+      [zoom, zoom - 1, zoom + 1].forEach(prefetchZoom => {
+        if (prefetchZoom < map.getMinZoom() || prefetchZoom > map.getMaxZoom()) {
+          return;
+        }
+
+        var lod = map.getMaxZoom() - prefetchZoom;
+        var padding = prefetchZoom === zoom ? 1 : 0;
+        var range = getTileRange(map, bounds, prefetchZoom, tileSize, padding);
+        for (var x = range.min.x; x <= range.max.x; x++) {
+          for (var y = range.min.y; y <= range.max.y; y++) {
+            // Leaflet is already loading the visible tiles itself
+            if (prefetchZoom === zoom && visibleRange.contains([x, y])) {
+              continue;
+            }
+            var url = getTileUrl(mapTilePathTemplate, mapMetadata, lod, x, y);
+            if (url && !prefetchedUrls.has(url)) {
+              urls.push(url);
+            }
+          }
+        }
+      });
+
+      urls.slice(0, maxTilesPerMove).forEach(url => {
+        prefetchedUrls.add(url);
+        fetch(url, { priority: 'low' }).catch(() => prefetchedUrls.delete(url));
+      });
+    });
+  }
+
+  map.on('moveend', prefetchAroundViewport);
+  prefetchAroundViewport();
+}
+
+// The page itself, plus the same origin scripts, stylesheets, images and map.json it has
+// loaded. These were fetched before the service worker controlled the page on a first visit,
+// so they need storing explicitly for the page to reload offline
+function getPageAssetUrls() {
+  var pageUrl = new URL(window.location.pathname, window.location.origin).href;
+  var assetUrls = performance.getEntriesByType('resource')
+    // Failed loads are listed too. responseStatus is missing in older browsers, and 0 when unknown
+    .filter(entry => !(entry.responseStatus >= 400))
+    .map(entry => new URL(entry.name))
+    .filter(url => url.origin === window.location.origin && !url.pathname.endsWith('/tile.jpg'))
+    .map(url => url.href);
+  return [pageUrl, ...new Set(assetUrls)];
+}
+
+// Requests are marked with OFFLINE_DOWNLOAD_HEADER so the service worker passes them straight
+// to the network, rather than also storing them in its LRU tile cache
+function makeOfflineDownloadRequest(url) {
+  return new Request(url, { headers: { [OFFLINE_DOWNLOAD_HEADER]: '1' } });
+}
+
+// Fetch the page and every tile between minLod and maxLod into the offline cache, which the
+// service worker checks first and never evicts. Returns the number of tiles now available offline.
+async function downloadMapForOffline(mapTilePathTemplate, mapMetadata, minLod, maxLod, onProgress = null, concurrency = 6) {
+  var offlineCache = await caches.open(getOfflineTileCacheName(mapMetadata));
+
+  // Always refresh the page assets, as they can change without the tiles changing. A missing
+  // asset shouldn't stop the tiles downloading, so each one is handled on its own
+  var assetUrls = getPageAssetUrls();
+  var assetResults = await Promise.allSettled(assetUrls.map(url => offlineCache.add(makeOfflineDownloadRequest(url))));
+  assetResults.forEach((result, index) => {
+    if (result.status === 'rejected') {
+      console.log(`Unable to download ${assetUrls[index]} for offline use: ${result.reason}`);
+    }
+  });
+
+  var urls = [];
+  for (var lod = minLod; lod <= maxLod; lod++) {
+    var lodRange = mapMetadata.lods[lod];
+    if (!lodRange) {
+      continue;
+    }
+    for (var x = lodRange.min[0]; x <= lodRange.max[0]; x++) {
+      for (var z = lodRange.min[1]; z <= lodRange.max[1]; z++) {
+        if (hasTile(mapMetadata, lod, x, z)) {
+          urls.push(L.Util.template(mapTilePathTemplate, { z: lod, x: x, y: z }));
+        }
+      }
+    }
+  }
+
+  var nextIndex = 0;
+  var completedCount = 0;
+  var cachedCount = 0;
+
+  async function downloadWorker() {
+    while (nextIndex < urls.length) {
+      var url = urls[nextIndex++];
+      try {
+        if (!(await offlineCache.match(url))) {
+          await offlineCache.add(makeOfflineDownloadRequest(url));
+        }
+        cachedCount++;
+      } catch (error) {
+        console.log(`Unable to download ${url} for offline use: ${error}`);
+      }
+      completedCount++;
+      if (onProgress) {
+        onProgress(completedCount, urls.length);
+      }
+    }
+  }
+
+  var workers = [];
+  for (var i = 0; i < concurrency; i++) {
+    workers.push(downloadWorker());
+  }
+  await Promise.all(workers);
+  return cachedCount;
+}
+
+// Adds a button which downloads the given LOD range for offline use
+function addOfflineDownloadControl(map, mapTilePathTemplate, mapMetadata, minLod, maxLod) {
+  if (!('caches' in window)) {
+    return;
+  }
+
+  var defaultLabel = '&#8681;';
+  var defaultTitle = `Download map for offline use (LOD ${minLod} to ${maxLod})`;
+
+  L.Control.OfflineDownload = L.Control.extend({
+    options: {
+      position: 'topleft'
+    },
+
+    onAdd: function (map) {
+      const container = L.DomUtil.create('div', 'leaflet-bar leaflet-control');
+      const button = L.DomUtil.create('a', '', container);
+      button.href = '#';
+      button.setAttribute('role', 'button');
+      button.title = defaultTitle;
+      button.innerHTML = defaultLabel;
+      button.style.width = 'auto';
+      button.style.minWidth = '30px';
+      var downloading = false;
+
+      L.DomEvent.disableClickPropagation(container);
+      L.DomEvent.on(button, 'click', function (e) {
+        L.DomEvent.preventDefault(e);
+        if (downloading) {
+          return;
+        }
+        downloading = true;
+
+        downloadMapForOffline(mapTilePathTemplate, mapMetadata, minLod, maxLod, (completed, total) => {
+          button.innerHTML = `${Math.floor(100 * completed / total)}%`;
+        }).then(cachedCount => {
+          button.title = `${cachedCount} tiles available offline`;
+        }).catch(error => {
+          console.log(`Offline download failed: ${error}`);
+          button.title = defaultTitle;
+        }).finally(() => {
+          button.innerHTML = defaultLabel;
+          downloading = false;
+        });
+      });
+
+      return container;
+    },
+  });
+
+  map.addControl(new L.Control.OfflineDownload());
+}
+
 // URL functions
 
-// During initialisation we can get the center and zoom from the URL
-function getCenterZoomFromURL() {
+// During initialisation we can get the center and LOD from the URL. Zoom levels depend on
+// the map's LOD depth, so links use ?lod=, and older ?zoom= links are converted to a LOD
+function getCenterLodFromURL() {
   const urlParams = new URLSearchParams(window.location.search);
   const centerParam = urlParams.get('center');
+  const lodParam = urlParams.get('lod');
   const zoomParam = urlParams.get('zoom');
   
-  if (centerParam && zoomParam) {
+  if (centerParam && (lodParam || zoomParam)) {
       const [lat, lng] = centerParam.split('-').map(parseFloat);
-      const zoom = parseInt(zoomParam);
+      const lod = lodParam ? parseInt(lodParam) : LEGACY_URL_MAX_ZOOM - parseInt(zoomParam);
       
-      if (!isNaN(lat) && !isNaN(lng) && !isNaN(zoom)) {
-        return {center: [lat, lng], zoom};
+      if (!isNaN(lat) && !isNaN(lng) && !isNaN(lod)) {
+        return {center: [lat, lng], lod};
       }
   }
   